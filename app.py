@@ -1,271 +1,565 @@
-import streamlit as st
-import pandas as pd
-import os
-from datetime import datetime
-import time
-import json
-import io
-import shutil
-
-# 导入安全 Token 和二维码生成库
-try:
-    from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
-    import qrcode
-    TOKEN_AVAILABLE = True
-except ImportError:
-    TOKEN_AVAILABLE = False
-    
-# Token 加密密钥
-SECRET_KEY = os.environ.get("STREAMLIT_SECRET_KEY", "your_insecure_default_secret_key_12345")
-def get_serializer(key):
-    return URLSafeTimedSerializer(key)
-
-# --- 1. 配置与初始化 ---
-ATHLETES_FILE = 'athletes.csv'
-RECORDS_FILE = 'timing_records.csv'
-CONFIG_FILE = 'config.json'
-CHECKPOINTS = ['START', 'MID', 'FINISH']
-ATHLETE_WELCOME_PAGE = "选手欢迎页"
-ATHLETE_LOGIN_PAGE = "选手登录"
-LOGIN_PAGE = "系统用户登录"
-
-# 初始化 Session State
-state_defaults = {
-    'logged_in': False,
-    'athlete_logged_in': False,
-    'username': None,
-    'user_role': None,
-    'athlete_username': None,
-    'page_selection': "选手登记",
-    'current_qr': {'token': None, 'generated_at': 0, 'expiry': 0, 'checkpoint': CHECKPOINTS[0]},
-    'show_manual_scan_info': False
-}
-for key, val in state_defaults.items():
-    if key not in st.session_state:
-        st.session_state[key] = val
-
-# --- 2. 核心辅助函数 ---
-def load_config():
-    default = {
-        "system_title": "梅州市第三人民医院赛事管理系统",
-        "registration_title": "选手资料登记",
-        "athlete_welcome_title": "恭喜您报名成功！",
-        "athlete_welcome_message": "感谢您参加本次赛事，祝取得好成绩。",
-        "athlete_sign_in_message": "请使用手机扫码登记。",
-        "athlete_notice": "【安全提醒】登山过程请注意安全。", 
-        "QR_CODE_BASE_URL": "http://127.0.0.1:8501", 
-        "QR_CODE_EXPIRY_SECONDS": 90,
-        "users": {"admin": {"password": "123", "role": "SuperAdmin"}}
-    }
-    if not os.path.exists(CONFIG_FILE):
-        save_config(default)
-        return default
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-        return {**default, **json.load(f)}
-
-def save_config(config_data):
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config_data, f, ensure_ascii=False, indent=4)
-
-def load_athletes_data():
-    cols = ['athlete_id', 'department', 'team_name', 'name', 'gender', 'phone', 'username', 'password']
-    if not os.path.exists(ATHLETES_FILE):
-        return pd.DataFrame(columns=cols)
-    df = pd.read_csv(ATHLETES_FILE, dtype={'athlete_id': str, 'username': str, 'password': str})
-    for col in cols:
-        if col not in df.columns: df[col] = "无"
-    return df
-
-def save_csv_safe(df, filename):
-    if os.path.exists(filename):
-        shutil.copy(filename, filename + ".bak")
-    df.to_csv(filename, index=False, encoding='utf-8-sig')
-
-def load_records_data():
-    if not os.path.exists(RECORDS_FILE):
-        return pd.DataFrame(columns=['athlete_id', 'checkpoint_type', 'timestamp'])
-    return pd.read_csv(RECORDS_FILE, parse_dates=['timestamp'], dtype={'athlete_id': str})
-
-def calculate_net_time(df_records):
-    if df_records.empty: return pd.DataFrame()
-    df_records['timestamp'] = pd.to_datetime(df_records['timestamp'], errors='coerce')
-    pivot = df_records.groupby(['athlete_id', 'checkpoint_type'])['timestamp'].min().unstack()
-    if 'START' not in pivot or 'FINISH' not in pivot: return pd.DataFrame()
-    df = pivot.dropna(subset=['START', 'FINISH']).copy()
-    df['total_time_sec'] = (df['FINISH'] - df['START']).dt.total_seconds()
-    return df[df['total_time_sec'] > 0].reset_index()
-
-def format_time(seconds):
-    if pd.isna(seconds): return 'N/A'
-    return f"{int(seconds//60):02d}:{seconds%60:06.3f}"
-
-# --- 3. 核心页面逻辑 ---
-
-def display_registration_form(config):
-    st.header(f"👤 {config['registration_title']}")
-    with st.form("reg_form", clear_on_submit=True):
-        col1, col2 = st.columns(2)
-        dept = col1.text_input("单位/部门")
-        team = col2.text_input("团队名称", value="无")
-        name = col1.text_input("姓名")
-        gender = col2.selectbox("性别", ["男", "女", "其他"])
-        phone = st.text_input("手机号")
-        if st.form_submit_button("提交报名"):
-            if not name or not phone: st.error("必填项不能为空"); return
-            df = load_athletes_data()
-            if phone in df['phone'].values: st.error("手机号已存在"); return
-            new_id = str(int(df['athlete_id'].astype(int).max() + 1)) if not df.empty else "1001"
-            new_row = pd.DataFrame([{'athlete_id': new_id, 'department': dept, 'team_name': team if team else "无", 
-                                     'name': name, 'gender': gender, 'phone': phone, 'username': name, 'password': phone}])
-            save_csv_safe(pd.concat([df, new_row], ignore_index=True), ATHLETES_FILE)
-            st.success(f"登记成功！编号: {new_id}")
-
-def display_athlete_welcome_page(config):
-    df_ath = load_athletes_data()
-    user = df_ath[df_ath['username'] == st.session_state.athlete_username].iloc[0]
-    
-    token = st.query_params.get('token')
-    if token:
-        st.query_params.clear()
-        try:
-            data = get_serializer(SECRET_KEY).loads(token, salt='checkpoint-timing', max_age=config['QR_CODE_EXPIRY_SECONDS'])
-            cp = data['cp']
-            df_rec = load_records_data()
-            if df_rec[(df_rec['athlete_id'] == user['athlete_id']) & (df_rec['checkpoint_type'] == cp)].empty:
-                new_rec = pd.DataFrame([{'athlete_id': user['athlete_id'], 'checkpoint_type': cp, 'timestamp': datetime.now()}])
-                save_csv_safe(pd.concat([df_rec, new_rec], ignore_index=True), RECORDS_FILE)
-                st.toast(f"✅ {cp} 签到成功！", icon="🎉")
-            time.sleep(1); st.rerun()
-        except: st.error("二维码无效或过期")
-
-    st.header(f"🎉 {config['athlete_welcome_title']}")
-    st.info(f"选手：{user['name']} | 团队：{user['team_name']}")
-    rec = load_records_data(); done = rec[rec['athlete_id'] == user['athlete_id']]['checkpoint_type'].tolist()
-    cols = st.columns(len(CHECKPOINTS))
-    for i, cp in enumerate(CHECKPOINTS): cols[i].metric(cp, "✅" if cp in done else "⚪")
-    st.markdown("---")
-    if st.button("▶️ 开启扫码计时", type="primary"): st.session_state.show_manual_scan_info = True
-    if st.session_state.show_manual_scan_info: st.warning(config['athlete_sign_in_message'])
-    st.info(f"📢 **赛事公告：**\n\n{config['athlete_notice']}")
-
-def display_team_ranking():
-    st.header("👥 团体成绩排名")
-    df_full = calculate_net_time(load_records_data()).merge(load_athletes_data(), on='athlete_id', how='left')
-    df_teams = df_full[df_full['team_name'] != "无"]
-    if df_teams.empty: st.info("暂无团体完赛记录"); return
-    team_stats = df_teams.groupby('team_name').agg(完赛人数=('athlete_id', 'count'), 总用时秒=('total_time_sec', 'sum')).reset_index()
-    team_stats['平均用时秒'] = team_stats['总用时秒'] / team_stats['完赛人数']
-    team_stats = team_stats.sort_values('平均用时秒').reset_index(drop=True)
-    team_stats['排名'] = team_stats.index + 1
-    team_stats['平均用时'] = team_stats['平均用时秒'].apply(format_time)
-    st.dataframe(team_stats[['排名', 'team_name', '完赛人数', '平均用时']], use_container_width=True, hide_index=True)
-
-# --- 4. 主程序 ---
-
-def main_app():
-    config = load_config()
-    st.sidebar.title(f"🏁 {config['system_title']}")
-    
-    pages = ["选手登记"]
-    if st.session_state.athlete_logged_in:
-        pages = [ATHLETE_WELCOME_PAGE]
-    elif st.session_state.logged_in:
-        role = st.session_state.user_role
-        pages += ["个人中心"]
-        if role in ["SuperAdmin", "Referee"]: pages += ["计时扫码", "数据管理"]
-        if role in ["SuperAdmin", "Leader"]: pages += ["个人排名", "团体排名"]
-        if role == "SuperAdmin": pages += ["归档与重置"]
-    else:
-        pages += [ATHLETE_LOGIN_PAGE, LOGIN_PAGE]
-
-    page = st.sidebar.radio("模块", pages, index=pages.index(st.session_state.page_selection) if st.session_state.page_selection in pages else 0)
-    st.session_state.page_selection = page
-
-    if page == "选手登记": display_registration_form(config)
-    elif page == ATHLETE_LOGIN_PAGE:
-        with st.form("a_l"):
-            u = st.text_input("姓名"); p = st.text_input("手机号", type="password")
-            if st.form_submit_button("选手登录"):
-                df = load_athletes_data()
-                if not df[(df['username'] == u) & (df['password'] == p)].empty:
-                    st.session_state.athlete_logged_in, st.session_state.athlete_username = True, u
-                    st.rerun()
-    elif page == ATHLETE_WELCOME_PAGE: display_athlete_welcome_page(config)
-    elif page == LOGIN_PAGE:
-        with st.form("m_l"):
-            u = st.text_input("账号"); p = st.text_input("密码", type="password")
-            if st.form_submit_button("管理登录"):
-                if u in config['users'] and config['users'][u]['password'] == p:
-                    st.session_state.logged_in, st.session_state.username, st.session_state.user_role = True, u, config['users'][u]['role']
-                    st.rerun()
-    elif page == "个人排名":
-        st.header("🏆 个人排名")
-        df_res = calculate_net_time(load_records_data()).merge(load_athletes_data(), on='athlete_id', how='left').sort_values('total_time_sec')
-        df_res['排名'] = range(1, len(df_res)+1); df_res['用时'] = df_res['total_time_sec'].apply(format_time)
-        st.dataframe(df_res[['排名', 'name', 'team_name', '用时']], use_container_width=True, hide_index=True)
-    elif page == "团体排名": display_team_ranking()
-    elif page == "计时扫码":
-        cp = st.selectbox("检查点", CHECKPOINTS); now = time.time(); qr_state = st.session_state.current_qr
-        if qr_state['checkpoint'] != cp or (now - qr_state['generated_at'] > config['QR_CODE_EXPIRY_SECONDS']):
-            token = get_serializer(SECRET_KEY).dumps({'cp': cp}, salt='checkpoint-timing')
-            st.session_state.current_qr = {'token': token, 'generated_at': now, 'url': f"{config['QR_CODE_BASE_URL']}?token={token}", 'checkpoint': cp}
-            st.rerun()
-        st.image(io.BytesIO(qrcode.make(st.session_state.current_qr['url']).tobytes() if False else qrcode.make(st.session_state.current_qr['url']).save(buf:=io.BytesIO(), format="PNG") or buf.getvalue()), caption=f"请扫描 {cp}", width=300)
-        st.write(f"刷新倒计时: {int(config['QR_CODE_EXPIRY_SECONDS'] - (now - qr_state['generated_at']))} 秒")
-        time.sleep(1); st.rerun()
-    elif page == "数据管理":
-        t1, t2 = st.tabs(["数据", "配置"])
-        with t1:
-            df = load_athletes_data(); edited = st.data_editor(df, num_rows="dynamic")
-            if st.button("同步数据"): save_csv_safe(edited, ATHLETES_FILE); st.success("已更新")
-        with t2:
-            config['system_title'] = st.text_input("标题", config['system_title'])
-            config['athlete_notice'] = st.text_area("公告", config['athlete_notice'])
-            if st.button("保存设置"): save_config(config); st.rerun()
-            if st.session_state.user_role == "SuperAdmin":
-                user_data = [{"用户名": u, "角色": d['role'], "密码": d['password']} for u, d in config['users'].items()]
-                ed = st.data_editor(pd.DataFrame(user_data), num_rows="dynamic", column_config={"角色": st.column_config.SelectboxColumn("权限", options=["SuperAdmin", "Leader", "Referee"])})
-                if st.button("保存账号"): config['users'] = {row['用户名']: {"password": str(row['密码']), "role": row['角色']} for _, row in ed.iterrows() if row['用户名']}; save_config(config); st.rerun()
-    elif page == "个人中心":
-        new_p = st.text_input("新密码", type="password")
-        if st.button("修改"): config['users'][st.session_state.username]['password'] = new_p; save_config(config); st.success("成功")
-    elif page == "归档与重置":
-        if st.button("执行重置", type="primary"):
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            for f in [ATHLETES_FILE, RECORDS_FILE]:
-                if os.path.exists(f): os.rename(f, f"ARCHIVE_{ts}_{f}")
-            st.rerun()
-
-    if st.sidebar.button("退出登录"):
-        st.session_state.athlete_logged_in = False
-        st.session_state.logged_in = False
-        st.rerun()
-
-    # --- 右下角版权信息 ---
-    st.markdown(
-        """
-        <style>
-        .footer {
-            position: fixed;
-            left: 0;
-            bottom: 0;
-            width: 100%;
-            background-color: rgba(255, 255, 255, 0.8);
-            color: #888888;
-            text-align: right;
-            padding-right: 20px;
-            padding-bottom: 5px;
-            font-size: 12px;
-            z-index: 100;
-        }
-        </style>
-        <div class="footer">
-            版权归设备科张明豪制作
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
-
-if __name__ == '__main__':
-    st.set_page_config(page_title="登山赛管理系统", layout="wide")
-    main_app()
+import streamlit as st
+import pandas as pd
+import numpy as np
+import os
+import csv
+import base64
+import hmac
+import struct
+import threading
+from datetime import datetime
+import time
+import json
+import io
+import gzip
+import shutil
+
+# 二维码库较重（连带 PIL），只探测可用性，真正 import 推迟到渲染时
+import importlib.util
+TOKEN_AVAILABLE = importlib.util.find_spec('qrcode') is not None
+
+# 可选：pyarrow 提供更快的 CSV 解析（多线程 C++ 解析器）
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+# 可选：orjson 的 JSON 编解码比标准库快数倍
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    
+# Token 加密密钥
+SECRET_KEY = os.environ.get("STREAMLIT_SECRET_KEY", "your_insecure_default_secret_key_12345")
+_TOKEN_KEY = SECRET_KEY.encode('utf-8')
+
+def mint_token(cp):
+    # 紧凑 Token：检查点序号(1B) + 签发时间(4B) + BLAKE2b-HMAC 前 8 字节
+    payload = struct.pack('>BI', CHECKPOINTS.index(cp), int(time.time()))
+    tag = hmac.new(_TOKEN_KEY, payload, 'blake2b').digest()[:8]
+    return base64.urlsafe_b64encode(payload + tag).decode('ascii').rstrip('=')
+
+def verify_token(token, max_age):
+    # 校验失败或过期一律抛 ValueError，由调用方统一提示
+    raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    if len(raw) != 13:
+        raise ValueError("bad token length")
+    payload, tag = raw[:5], raw[5:]
+    if not hmac.compare_digest(hmac.new(_TOKEN_KEY, payload, 'blake2b').digest()[:8], tag):
+        raise ValueError("bad signature")
+    cp_id, issued_at = struct.unpack('>BI', payload)
+    if cp_id >= len(CHECKPOINTS) or time.time() - issued_at > max_age:
+        raise ValueError("expired")
+    return CHECKPOINTS[cp_id]
+
+# --- 1. 配置与初始化 ---
+ATHLETES_FILE = 'athletes.csv'
+RECORDS_FILE = 'timing_records.csv'
+CONFIG_FILE = 'config.json'
+CHECKPOINTS = ['START', 'MID', 'FINISH']
+ATHLETE_WELCOME_PAGE = "选手欢迎页"
+ATHLETE_LOGIN_PAGE = "选手登录"
+LOGIN_PAGE = "系统用户登录"
+
+# 初始化 Session State
+state_defaults = {
+    'logged_in': False,
+    'athlete_logged_in': False,
+    'username': None,
+    'user_role': None,
+    'athlete_username': None,
+    'page_selection': "选手登记",
+    'current_qr': {'token': None, 'generated_at': 0, 'expiry': 0, 'checkpoint': CHECKPOINTS[0]},
+    'show_manual_scan_info': False
+}
+for key, val in state_defaults.items():
+    if key not in st.session_state:
+        st.session_state[key] = val
+
+# --- 2. 核心辅助函数 ---
+def load_config():
+    default = {
+        "system_title": "梅州市第三人民医院赛事管理系统",
+        "registration_title": "选手资料登记",
+        "athlete_welcome_title": "恭喜您报名成功！",
+        "athlete_welcome_message": "感谢您参加本次赛事，祝取得好成绩。",
+        "athlete_sign_in_message": "请使用手机扫码登记。",
+        "athlete_notice": "【安全提醒】登山过程请注意安全。", 
+        "QR_CODE_BASE_URL": "http://127.0.0.1:8501",
+        "QR_CODE_EXPIRY_SECONDS": 90,
+        "next_athlete_id": 1001,
+        "users": {"admin": {"password": "123", "role": "SuperAdmin"}}
+    }
+    if not os.path.exists(CONFIG_FILE):
+        save_config(default)
+        return default
+    return {**default, **_read_config(os.path.getmtime(CONFIG_FILE))}
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _read_config(mtime):
+    with open(CONFIG_FILE, 'rb') as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def save_config(config_data):
+    # 内容没变就不落盘（cache_data 返回副本，不怕调用方改字典）
+    try:
+        if _read_config(os.path.getmtime(CONFIG_FILE)) == config_data:
+            return
+    except (OSError, ValueError):
+        pass
+    tmp = CONFIG_FILE + '.tmp'
+    if orjson:
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(config_data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(config_data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, CONFIG_FILE)
+
+ATHLETES_COLUMNS = ['athlete_id', 'department', 'team_name', 'name', 'gender', 'phone', 'username', 'password']
+
+def ensure_csv(path, columns):
+    # 保证文件存在且带表头；稳态只花一次 getsize，免去各处 exists+空表特判
+    try:
+        if os.path.getsize(path) > 0:
+            return
+    except OSError:
+        pass
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        csv.writer(f).writerow(columns)
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _read_athletes(mtime):
+    df = pd.read_csv(ATHLETES_FILE, engine=CSV_ENGINE,
+                     dtype={'athlete_id': str, 'phone': str, 'username': str, 'password': str})
+    for col in ATHLETES_COLUMNS:
+        if col not in df.columns: df[col] = "无"
+    return df
+
+def load_athletes_data():
+    # 以文件 mtime 作缓存键：文件未变时直接复用解析结果，变更后自动失效
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    return _read_athletes(os.path.getmtime(ATHLETES_FILE))
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _athlete_phone_set(mtime):
+    # 统一转 str：手机号列可能被解析成整数，直接用 values 比较会永远不命中
+    return set(_read_athletes(mtime)['phone'].astype(str))
+
+def get_phone_set():
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    return _athlete_phone_set(os.path.getmtime(ATHLETES_FILE))
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _athletes_indexed(mtime):
+    # 排名页 join 用：athlete_id 做索引，右表免去哈希构建，也不把手机号/密码带进结果
+    return _read_athletes(mtime).set_index('athlete_id')[['name', 'team_name']]
+
+def get_athletes_indexed():
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    return _athletes_indexed(os.path.getmtime(ATHLETES_FILE))
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _athletes_by_username(mtime):
+    # 重名保留第一条，与登录口径一致
+    return _read_athletes(mtime).drop_duplicates('username').set_index('username', drop=False)
+
+def get_athlete_by_username(username):
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    df = _athletes_by_username(os.path.getmtime(ATHLETES_FILE))
+    return df.loc[username] if username in df.index else None
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _athlete_credentials(mtime):
+    # 重名时保留第一条，与欢迎页 iloc[0] 的取行规则一致
+    df = _read_athletes(mtime)
+    creds = {}
+    for u, p in zip(df['username'], df['password']):
+        creds.setdefault(u, p)
+    return creds
+
+def get_athlete_credentials():
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    return _athlete_credentials(os.path.getmtime(ATHLETES_FILE))
+
+def next_athlete_id(config, df):
+    # 计数器保证归档重置后编号不回退；与现有数据取 max 以容忍手工改档
+    ids = pd.to_numeric(df['athlete_id'], errors='coerce').dropna()
+    max_id = int(ids.max()) if not ids.empty else 1000
+    return max(int(config.get('next_athlete_id', 1001)), max_id + 1)
+
+def append_athlete(row):
+    # 追加单行；旧文件表头可能缺列（如 team_name），此时一次性重写升级表头，之后均为追加
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    with open(ATHLETES_FILE, 'r', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f))
+    if set(ATHLETES_COLUMNS) <= set(header):
+        with open(ATHLETES_FILE, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([row.get(c, "无") for c in header])
+    else:
+        df = load_athletes_data()
+        save_csv_safe(pd.concat([df, pd.DataFrame([row])], ignore_index=True), ATHLETES_FILE)
+
+def save_csv_safe(df, filename):
+    # 先写临时文件再原子替换，崩溃不会留下半截文件；.bak 快照最多 5 分钟拷一次
+    if os.path.exists(filename):
+        bak = filename + ".bak"
+        try:
+            stale = time.time() - os.path.getmtime(bak) > 300
+        except OSError:
+            stale = True
+        if stale:
+            shutil.copy(filename, bak)
+    tmp = filename + ".tmp"
+    if CSV_ENGINE == 'pyarrow':
+        # C++ 写出比 pandas.to_csv 快数倍；BOM 手工补上以保持 utf-8-sig 行为
+        import pyarrow.csv as pacsv
+        with open(tmp, 'wb') as f:
+            f.write(b'\xef\xbb\xbf')
+            pacsv.write_csv(pyarrow.Table.from_pandas(df, preserve_index=False), f,
+                            write_options=pacsv.WriteOptions(quoting_style='needed'))
+    else:
+        df.to_csv(tmp, index=False, encoding='utf-8-sig')
+    os.replace(tmp, filename)
+    # 全量重写后主动丢弃旧版本的缓存条目（mtime 键只负责“取不到旧值”，不负责清内存）
+    _read_athletes.clear()
+    _athlete_phone_set.clear()
+    _read_records.clear()
+    _done_map.clear()
+
+RECORDS_COLUMNS = ['athlete_id', 'checkpoint_type', 'timestamp']
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _read_records(mtime):
+    df = pd.read_csv(RECORDS_FILE, parse_dates=['timestamp'], engine=CSV_ENGINE,
+                     dtype={'athlete_id': str, 'checkpoint_type': str}, date_format='ISO8601')
+    # 只有三种取值，转 category 让 groupby 按 int8 编码聚合；athlete_id 保持 str 以便与选手表 merge
+    df['checkpoint_type'] = pd.Categorical(df['checkpoint_type'], categories=CHECKPOINTS)
+    return df
+
+def load_records_data():
+    ensure_csv(RECORDS_FILE, RECORDS_COLUMNS)
+    return _read_records(os.path.getmtime(RECORDS_FILE))
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _done_map(mtime):
+    grouped = _read_records(mtime).groupby('athlete_id', sort=False)['checkpoint_type']
+    return {aid: set(cps) for aid, cps in grouped}
+
+def get_done_checkpoints(athlete_id):
+    # 单选手的已签到集合：整表扫描换成按文件版本缓存的字典查询
+    ensure_csv(RECORDS_FILE, RECORDS_COLUMNS)
+    return _done_map(os.path.getmtime(RECORDS_FILE)).get(athlete_id, set())
+
+# Streamlit 各会话跑在同一进程的不同线程里，查重+追加需要整体互斥
+_records_lock = threading.RLock()
+
+def append_record(athlete_id, checkpoint_type, ts):
+    # 追加单行，避免整文件重写
+    with _records_lock:
+        ensure_csv(RECORDS_FILE, RECORDS_COLUMNS)
+        with open(RECORDS_FILE, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([athlete_id, checkpoint_type, ts.isoformat(sep=' ')])
+
+def get_archived_files():
+    # 单次 scandir + 前缀过滤；文件名以时间戳开头，倒序即最新在前
+    with os.scandir('.') as it:
+        names = [e.name for e in it if e.is_file() and e.name.startswith('ARCHIVE_')]
+    return sorted(names, reverse=True)
+
+def _compress_archives(paths):
+    # 归档压缩放后台线程，重置按钮只付 rename 的代价；压完删原件
+    for p in paths:
+        with open(p, 'rb') as src, gzip.open(p + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(p)
+
+def calculate_net_time(df_records):
+    if df_records.empty: return pd.DataFrame()
+    if not pd.api.types.is_datetime64_any_dtype(df_records['timestamp']):
+        # 正常路径 loader 已按日期解析，这里只兜底手工构造的帧
+        df_records = df_records.assign(timestamp=pd.to_datetime(df_records['timestamp'], errors='coerce'))
+    # 净时只看起点/终点，提前过滤掉 MID 让分组数减半
+    df_records = df_records[df_records['checkpoint_type'].isin(('START', 'FINISH'))]
+    pivot = df_records.groupby(['athlete_id', 'checkpoint_type'], sort=False, observed=True)['timestamp'].min().unstack()
+    if 'START' not in pivot or 'FINISH' not in pivot: return pd.DataFrame()
+    # 纯 numpy int64 算秒数，绕开 .dt 访问器；NaT 变成极大负数，被 > 0 一并过滤
+    td = (pivot['FINISH'] - pivot['START']).to_numpy().astype('timedelta64[ns]')
+    total = td.view('i8') * 1e-9
+    return pivot.assign(total_time_sec=total)[total > 0].reset_index()
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _compute_ranking(records_mtime, athletes_mtime):
+    df_net = calculate_net_time(_read_records(records_mtime))
+    if df_net.empty:
+        return pd.DataFrame(columns=['排名', 'name', 'team_name', '用时'])
+    df_res = df_net.join(_athletes_indexed(athletes_mtime), on='athlete_id')
+    # 稳定 argsort 直接给出重排下标，省去 sort_values 的比较键构建；并列时保持原序
+    order = np.argsort(df_res['total_time_sec'].to_numpy(), kind='stable')
+    df_res = df_res.iloc[order].reset_index(drop=True)
+    df_res['排名'] = np.arange(1, len(df_res) + 1)
+    df_res['用时'] = format_time_series(df_res['total_time_sec'])
+    return df_res[['排名', 'name', 'team_name', '用时']]
+
+def compute_ranking():
+    # 排名是 (records, athletes) 两个文件的纯函数，按 mtime 缓存整个流水线
+    ensure_csv(RECORDS_FILE, RECORDS_COLUMNS)
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    return _compute_ranking(os.path.getmtime(RECORDS_FILE), os.path.getmtime(ATHLETES_FILE))
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _compute_team_ranking(records_mtime, athletes_mtime):
+    df_net = calculate_net_time(_read_records(records_mtime))
+    if df_net.empty:
+        return pd.DataFrame(columns=['排名', 'team_name', '完赛人数', '平均用时'])
+    df_full = df_net.join(_athletes_indexed(athletes_mtime)[['team_name']], on='athlete_id')
+    df_teams = df_full[df_full['team_name'] != "无"]
+    if df_teams.empty:
+        return pd.DataFrame(columns=['排名', 'team_name', '完赛人数', '平均用时'])
+    # 单次 groupby 直接聚合出人数与均值，省去 sum 后再除的一步
+    team_stats = df_teams.groupby('team_name').agg(
+        完赛人数=('athlete_id', 'size'), 平均用时秒=('total_time_sec', 'mean')).reset_index()
+    team_stats = team_stats.sort_values('平均用时秒').reset_index(drop=True)
+    team_stats['排名'] = team_stats.index + 1
+    team_stats['平均用时'] = format_time_series(team_stats['平均用时秒'])
+    return team_stats[['排名', 'team_name', '完赛人数', '平均用时']]
+
+def compute_team_ranking():
+    ensure_csv(RECORDS_FILE, RECORDS_COLUMNS)
+    ensure_csv(ATHLETES_FILE, ATHLETES_COLUMNS)
+    return _compute_team_ranking(os.path.getmtime(RECORDS_FILE), os.path.getmtime(ATHLETES_FILE))
+
+def render_qr_png(url):
+    # 二维码只在换发 Token 时渲染一次，倒计时重跑直接复用字节
+    import qrcode
+    buf = io.BytesIO()
+    qrcode.make(url).save(buf, format="PNG")
+    return buf.getvalue()
+
+def format_time(seconds):
+    if pd.isna(seconds): return 'N/A'
+    return f"{int(seconds//60):02d}:{seconds%60:06.3f}"
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _csv_bytes(df):
+    # 导出序列化只做一次（按帧内容缓存），重跑页面不再重复 to_csv
+    return df.to_csv(index=False).encode('utf-8-sig')
+
+def format_time_series(seconds):
+    # 批量版 format_time：分/秒用 numpy 一次算完，只留最终拼串走 Python
+    secs = seconds.to_numpy(dtype=float)
+    mins = np.where(np.isnan(secs), 0, secs // 60).astype(np.int64)
+    rem = secs - mins * 60
+    return pd.Series([('N/A' if r != r else f"{m:02d}:{r:06.3f}") for m, r in zip(mins.tolist(), rem.tolist())],
+                     index=seconds.index)
+
+# --- 3. 核心页面逻辑 ---
+
+def display_registration_form(config):
+    st.header(f"👤 {config['registration_title']}")
+    with st.form("reg_form", clear_on_submit=True):
+        col1, col2 = st.columns(2)
+        dept = col1.text_input("单位/部门")
+        team = col2.text_input("团队名称", value="无")
+        name = col1.text_input("姓名")
+        gender = col2.selectbox("性别", ["男", "女", "其他"])
+        phone = st.text_input("手机号")
+        if st.form_submit_button("提交报名"):
+            if not name or not phone: st.error("必填项不能为空"); return
+            df = load_athletes_data()
+            if phone in get_phone_set(): st.error("手机号已存在"); return
+            new_id = next_athlete_id(config, df)
+            append_athlete({'athlete_id': str(new_id), 'department': dept, 'team_name': team if team else "无",
+                            'name': name, 'gender': gender, 'phone': phone, 'username': name, 'password': phone})
+            config['next_athlete_id'] = new_id + 1
+            save_config(config)
+            st.success(f"登记成功！编号: {new_id}")
+
+def display_athlete_welcome_page(config):
+    user = get_athlete_by_username(st.session_state.athlete_username)
+    if user is None:
+        # 数据被归档/重置后选手记录不复存在，退出登录回到首页
+        st.session_state.athlete_logged_in = False
+        st.rerun()
+
+    token = st.query_params.get('token')
+    if token:
+        st.query_params.clear()
+        try:
+            cp = verify_token(token, config['QR_CODE_EXPIRY_SECONDS'])
+        except Exception:
+            cp = None
+            st.error("二维码无效或过期")
+        if cp:
+            # rerun 靠抛控制流异常实现，必须放在 try 之外，否则会被当成坏 Token
+            with _records_lock:
+                if cp not in get_done_checkpoints(user['athlete_id']):
+                    append_record(user['athlete_id'], cp, datetime.now())
+                    # 结果放进会话，重跑后再提示，省掉为展示 toast 而 sleep 的一秒
+                    st.session_state.last_scan = cp
+            st.rerun()
+
+    last_scan = st.session_state.pop('last_scan', None)
+    if last_scan:
+        st.toast(f"✅ {last_scan} 签到成功！", icon="🎉")
+
+    st.header(f"🎉 {config['athlete_welcome_title']}")
+    st.info(f"选手：{user['name']} | 团队：{user['team_name']}")
+    _welcome_progress(user['athlete_id'])
+    st.markdown("---")
+    if st.button("▶️ 开启扫码计时", type="primary"): st.session_state.show_manual_scan_info = True
+    if st.session_state.show_manual_scan_info: st.warning(config['athlete_sign_in_message'])
+    st.info(f"📢 **赛事公告：**\n\n{config['athlete_notice']}")
+
+@st.fragment(run_every=5)
+def _welcome_progress(athlete_id):
+    # 签到进度每 5 秒独立刷新（缓存命中只花一次 stat），整页不重跑
+    done = get_done_checkpoints(athlete_id)
+    cols = st.columns(len(CHECKPOINTS))
+    for i, cp in enumerate(CHECKPOINTS): cols[i].metric(cp, "✅" if cp in done else "⚪")
+
+@st.fragment(run_every=1)
+def display_timing_scanner(config):
+    # run_every 只重跑本片段：倒计时每秒刷新，侧边栏/配置/登录检查不再陪跑
+    if not TOKEN_AVAILABLE:
+        st.error("未安装 qrcode 库，无法生成计时二维码"); return
+    cp = st.selectbox("检查点", CHECKPOINTS)
+    # 过期判断用单调时钟，不受 NTP 校时影响；Token 内部的签发时间仍是墙钟
+    now = time.monotonic(); qr_state = st.session_state.current_qr
+    if (qr_state.get('png') is None or qr_state['checkpoint'] != cp
+            or (now - qr_state['generated_at'] > config['QR_CODE_EXPIRY_SECONDS'])):
+        token = mint_token(cp)
+        url = f"{config['QR_CODE_BASE_URL']}?token={token}"
+        qr_state = {'token': token, 'generated_at': now, 'url': url,
+                    'checkpoint': cp, 'png': render_qr_png(url)}
+        st.session_state.current_qr = qr_state
+    st.image(qr_state['png'], caption=f"请扫描 {cp}", width=300)
+    st.write(f"刷新倒计时: {int(config['QR_CODE_EXPIRY_SECONDS'] - (now - qr_state['generated_at']))} 秒")
+
+def display_team_ranking():
+    st.header("👥 团体成绩排名")
+    team_stats = compute_team_ranking()
+    if team_stats.empty: st.info("暂无团体完赛记录"); return
+    st.dataframe(team_stats, use_container_width=True, hide_index=True)
+
+# --- 4. 主程序 ---
+
+def main_app():
+    config = load_config()
+    st.sidebar.title(f"🏁 {config['system_title']}")
+    
+    pages = ["选手登记"]
+    if st.session_state.athlete_logged_in:
+        pages = [ATHLETE_WELCOME_PAGE]
+    elif st.session_state.logged_in:
+        role = st.session_state.user_role
+        pages += ["个人中心"]
+        if role in ["SuperAdmin", "Referee"]: pages += ["计时扫码", "数据管理"]
+        if role in ["SuperAdmin", "Leader"]: pages += ["个人排名", "团体排名"]
+        if role == "SuperAdmin": pages += ["归档与重置"]
+    else:
+        pages += [ATHLETE_LOGIN_PAGE, LOGIN_PAGE]
+
+    page = st.sidebar.radio("模块", pages, index=pages.index(st.session_state.page_selection) if st.session_state.page_selection in pages else 0)
+    st.session_state.page_selection = page
+
+    if page == "选手登记": display_registration_form(config)
+    elif page == ATHLETE_LOGIN_PAGE:
+        with st.form("a_l"):
+            u = st.text_input("姓名"); p = st.text_input("手机号", type="password")
+            if st.form_submit_button("选手登录"):
+                creds = get_athlete_credentials()
+                if u in creds and creds[u] == p:
+                    st.session_state.athlete_logged_in, st.session_state.athlete_username = True, u
+                    st.rerun()
+    elif page == ATHLETE_WELCOME_PAGE: display_athlete_welcome_page(config)
+    elif page == LOGIN_PAGE:
+        with st.form("m_l"):
+            u = st.text_input("账号"); p = st.text_input("密码", type="password")
+            if st.form_submit_button("管理登录"):
+                # encode 后比较：compare_digest 恒定耗时，且 str 形式不接受非 ASCII
+                if u in config['users'] and hmac.compare_digest(str(config['users'][u]['password']).encode(), p.encode()):
+                    st.session_state.logged_in, st.session_state.username, st.session_state.user_role = True, u, config['users'][u]['role']
+                    st.rerun()
+    elif page == "个人排名":
+        st.header("🏆 个人排名")
+        df_show = compute_ranking()
+        st.dataframe(df_show, use_container_width=True, hide_index=True)
+        st.download_button("⬇️ 导出成绩 CSV", _csv_bytes(df_show), file_name="个人排名.csv", mime="text/csv")
+    elif page == "团体排名": display_team_ranking()
+    elif page == "计时扫码": display_timing_scanner(config)
+    elif page == "数据管理":
+        t1, t2 = st.tabs(["数据", "配置"])
+        with t1:
+            df = load_athletes_data(); edited = st.data_editor(df, num_rows="dynamic")
+            if st.button("同步数据"):
+                if not edited['athlete_id'].is_unique:
+                    st.error("athlete_id 存在重复，未保存")
+                elif edited.equals(df):
+                    st.info("数据无变化")
+                else:
+                    save_csv_safe(edited, ATHLETES_FILE); st.success("已更新")
+        with t2:
+            config['system_title'] = st.text_input("标题", config['system_title'])
+            config['athlete_notice'] = st.text_area("公告", config['athlete_notice'])
+            if st.button("保存设置"): save_config(config); st.rerun()
+            if st.session_state.user_role == "SuperAdmin":
+                # 表单内的编辑只在点保存时才回传，中途敲键不再触发整页重跑
+                with st.form("user_mgmt"):
+                    user_data = [{"用户名": u, "角色": d['role'], "密码": d['password']} for u, d in config['users'].items()]
+                    ed = st.data_editor(pd.DataFrame(user_data), num_rows="dynamic", column_config={"角色": st.column_config.SelectboxColumn("权限", options=["SuperAdmin", "Leader", "Referee"])})
+                    if st.form_submit_button("保存账号"): config['users'] = {row['用户名']: {"password": str(row['密码']), "role": row['角色']} for _, row in ed.iterrows() if row['用户名']}; save_config(config); st.rerun()
+    elif page == "个人中心":
+        new_p = st.text_input("新密码", type="password")
+        if st.button("修改"): config['users'][st.session_state.username]['password'] = new_p; save_config(config); st.success("成功")
+    elif page == "归档与重置":
+        if st.button("执行重置", type="primary"):
+            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+            archived = []
+            for f in [ATHLETES_FILE, RECORDS_FILE]:
+                if os.path.exists(f):
+                    os.rename(f, f"ARCHIVE_{ts}_{f}"); archived.append(f"ARCHIVE_{ts}_{f}")
+            if archived:
+                threading.Thread(target=_compress_archives, args=(archived,), daemon=True).start()
+            st.rerun()
+        archives = get_archived_files()
+        if archives:
+            st.caption("历史归档：")
+            st.text("\n".join(archives))
+
+    if st.sidebar.button("退出登录"):
+        st.session_state.athlete_logged_in = False
+        st.session_state.logged_in = False
+        st.rerun()
+
+    # --- 右下角版权信息 ---
+    st.markdown(
+        """
+        <style>
+        .footer {
+            position: fixed;
+            left: 0;
+            bottom: 0;
+            width: 100%;
+            background-color: rgba(255, 255, 255, 0.8);
+            color: #888888;
+            text-align: right;
+            padding-right: 20px;
+            padding-bottom: 5px;
+            font-size: 12px;
+            z-index: 100;
+        }
+        </style>
+        <div class="footer">
+            版权归设备科张明豪制作
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+
+if __name__ == '__main__':
+    st.set_page_config(page_title="登山赛管理系统", layout="wide")
+    main_app()